@@ -4,18 +4,28 @@
 
 from __future__ import annotations
 import logging
-from datetime import datetime, date
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from decimal import Decimal, InvalidOperation
 import csv
+import html
+import io
+from dataclasses import dataclass
 from enum import Enum
+from functools import cache
 import json
-from typing import Any
+from typing import IO, TYPE_CHECKING, Any, Collection, Iterator, cast
 from typeguard import check_type, TypeCheckError
 import boto3
-from mypy_boto3_s3.client import S3Client
-from mypy_boto3_s3.type_defs import GetObjectOutputTypeDef
-from mypy_boto3_ses.client import SESClient
 from botocore import exceptions
-import yattag
+
+# Stub packages are only needed by mypy, not at runtime
+if TYPE_CHECKING:
+    from botocore.response import StreamingBody
+    from mypy_boto3_s3.client import S3Client
+    from mypy_boto3_s3.type_defs import GetObjectOutputTypeDef
+    from mypy_boto3_ses.client import SESClient
 
 
 # Logging
@@ -24,30 +34,76 @@ logger = logging.getLogger(__name__)
 
 
 # Constants
-DATE = "%Y-%m-%d"
 DISPLAY_DATE = "%m/%d/%y"
-MONEY_FORMAT = "{0:.2f}"
+MONEY_FORMAT = ".2f"
+CENTS = 100
+CENT = Decimal("0.01")
 CONFIG_BUCKET, CONFIG_KEY = "rmanalyzer-config", "config.json"
+MAX_WORKERS = 8
+TRANSACTION_COLUMNS = (
+    "Date",
+    "Name",
+    "Account Number",
+    "Amount",
+    "Category",
+    "Ignored From",
+)
+# boto3's default session isn't thread-safe, so serialize client creation
+CLIENT_LOCK = threading.Lock()
+# Parsed configs by (bucket, key), with the ETag they were read at
+CONFIG_CACHE: dict[tuple[str, str], tuple[str, dict]] = dict()
 
 
 # Functions
-def get_s3_content(bucket: str, key: str) -> str:
-    s3: S3Client = boto3.client("s3")
+@cache
+def get_s3_client() -> S3Client:
+    with CLIENT_LOCK:
+        return boto3.client("s3")
+
+
+@cache
+def get_ses_client() -> SESClient:
+    with CLIENT_LOCK:
+        return boto3.client("ses", region_name="us-east-1")
+
+
+def get_s3_body(bucket: str, key: str) -> StreamingBody:
     try:
-        response: GetObjectOutputTypeDef = s3.get_object(Bucket=bucket, Key=key)
-        return response["Body"].read().decode("utf-8")
+        response: GetObjectOutputTypeDef = get_s3_client().get_object(
+            Bucket=bucket, Key=key
+        )
+        return response["Body"]
     except exceptions.ClientError as ex:
         logger.error("Error reading S3 file: %s", ex)
         raise
 
 
+def get_s3_content(bucket: str, key: str) -> bytes:
+    return get_s3_body(bucket, key).read()
+
+
+def get_s3_etag(bucket: str, key: str) -> str:
+    try:
+        return get_s3_client().head_object(Bucket=bucket, Key=key)["ETag"]
+    except exceptions.ClientError as ex:
+        logger.error("Error reading S3 file metadata: %s", ex)
+        raise
+
+
 def get_config(bucket: str, key: str) -> dict:
-    config = get_s3_content(bucket, key)
+    # Reuse the parsed config across warm invocations until the object changes
+    etag = get_s3_etag(bucket, key)
+    cached = CONFIG_CACHE.get((bucket, key))
+    if cached and cached[0] == etag:
+        return cached[1]
+    content = get_s3_content(bucket, key)
     try:
-        return json.loads(config)
+        config = json.loads(content)
     except json.JSONDecodeError as ex:
         logger.error("Error loading config: %s", ex)
         raise
+    CONFIG_CACHE[(bucket, key)] = (etag, config)
+    return config
 
 
 def validate_config(config: dict) -> None:
@@ -64,40 +120,86 @@ def validate_config(config: dict) -> None:
         raise
 
 
-def to_transaction(row: dict) -> Transaction | None:
+def to_transaction(row: list[str], columns: dict[str, int]) -> Transaction | None:
     try:
-        transaction_date = datetime.strptime(row["Date"], DATE).date()
-        transaction_name = str(row["Name"])
-        transaction_account_number = int(row["Account Number"])
-        transaction_amount = float(row["Amount"])
-        transaction_category = Category(row["Category"])
-        transaction_ignore = IgnoredFrom(row["Ignored From"])
+        # fromisoformat also takes forms like 20230101; keep to YYYY-MM-DD
+        date_value = row[columns["Date"]]
+        if len(date_value) != 10 or date_value[4] != "-" or date_value[7] != "-":
+            raise ValueError(f"Invalid date: {date_value!r}")
+        transaction_date = date.fromisoformat(date_value)
+        transaction_name = row[columns["Name"]]
+        transaction_account_number = int(row[columns["Account Number"]])
+        # Quantizing rejects inf/nan and huge values instead of overflowing
+        transaction_amount_cents = int(
+            Decimal(row[columns["Amount"]]).quantize(CENT) * CENTS
+        )
+        transaction_category = CATEGORY_BY_VALUE[row[columns["Category"]]]
+        transaction_ignore = IGNORED_FROM_BY_VALUE[row[columns["Ignored From"]]]
         return Transaction(
             transaction_date,
             transaction_name,
             transaction_account_number,
-            transaction_amount,
+            transaction_amount_cents,
             transaction_category,
             transaction_ignore,
         )
-    except (ValueError, KeyError) as ex:
+    except (ValueError, KeyError, IndexError, InvalidOperation) as ex:
         logger.warning("Invalid transaction data in row %s: %s", row, ex)
         return None
 
 
-def get_transactions(bucket: str, key: str) -> list[Transaction]:
-    content = get_s3_content(bucket, key)
-    rows = csv.DictReader(content.splitlines())
-    transactions = list()
+def is_excluded(
+    row: list[str], columns: dict[str, int], accounts: Collection[int]
+) -> bool:
+    # Check the cheap columns first so dropped rows skip the full conversion
+    try:
+        ignore = row[columns["Ignored From"]]
+        if ignore in IGNORED_FROM_BY_VALUE and ignore != IgnoredFrom.NOTHING.value:
+            return True
+        return int(row[columns["Account Number"]]) not in accounts
+    except (ValueError, IndexError):
+        # Leave malformed rows to to_transaction so they get logged
+        return False
+
+
+def parse_transactions(
+    stream: IO[bytes], accounts: Collection[int] | None = None
+) -> Iterator[Transaction]:
+    # Decode as rows are read so only a buffer of the file is held at once
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    rows = csv.reader(text)
+    # Map column names to positions once instead of building a dict per row
+    columns = {name: i for i, name in enumerate(next(rows, []))}
+    # Reject files without the expected header up front instead of per row
+    missing = [c for c in TRANSACTION_COLUMNS if c not in columns]
+    if missing:
+        logger.warning("Spreadsheet missing columns: %s", ", ".join(missing))
+        return
     for row in rows:
-        transaction = to_transaction(row)
+        # csv.reader yields [] for blank lines, which DictReader used to skip
+        if not row:
+            continue
+        if accounts is not None and is_excluded(row, columns, accounts):
+            continue
+        transaction = to_transaction(row, columns)
         if transaction:
-            transactions.append(transaction)
-    return transactions
+            yield transaction
+
+
+def get_transactions(
+    bucket: str, key: str, accounts: Collection[int] | None = None
+) -> list[Transaction]:
+    # Parse straight off the S3 body instead of reading it all first
+    with get_s3_body(bucket, key) as body:
+        # StreamingBody is a readable IOBase, which its stubs don't spell out
+        return list(parse_transactions(cast("IO[bytes]", body), accounts))
 
 
 def to_currency(num: float) -> str:
-    return MONEY_FORMAT.format(num)
+    # Empty categories are the common case; skip float formatting for them
+    if not num:
+        return "0.00"
+    return format(num, MONEY_FORMAT)
 
 
 def get_members(people_config: list[dict]) -> list[Person]:
@@ -112,6 +214,59 @@ def get_members(people_config: list[dict]) -> list[Person]:
     ]
 
 
+def render_row(cells: list[str], cell_tag: str = "td") -> str:
+    return ROW_TEMPLATES[cell_tag].format(*(html.escape(c, quote=False) for c in cells))
+
+
+def render_table_header() -> str:
+    return render_row(["", *(c.value for c in Category), "Total"], "th")
+
+
+def render_table_rows(group: Group) -> str:
+    rows = list()
+    # Create a row for each person
+    for p in group.members:
+        expenses, total = p.get_category_expenses()
+        rows.append(
+            render_row(
+                [
+                    p.name,
+                    *(to_currency(expenses[c]) for c in Category),
+                    to_currency(total),
+                ]
+            )
+        )
+    # If there are only two people, create a row for the differences
+    if len(group.members) == 2:
+        p1, p2 = group.members
+        rows.append(
+            render_row(
+                [
+                    "Difference",
+                    *(
+                        to_currency(group.get_expenses_difference(p1, p2, c))
+                        for c in Category
+                    ),
+                    to_currency(group.get_expenses_difference(p1, p2)),
+                ]
+            )
+        )
+    return "".join(rows)
+
+
+def render_summary(group: Group) -> str:
+    # Expenses summary sentence
+    if len(group.members) != 2:
+        return str()
+    p1, p2 = group.members
+    k = 0.47  # Just set the scale factor here for now
+    sentence = (
+        f"Using a scale factor of {k} for {p1.name}, {p1.name} owes {p2.name}: "
+        f"{to_currency(group.get_debt(p1, p2, k))}"
+    )
+    return f"<p>{html.escape(sentence, quote=False)}</p>"
+
+
 # Classes
 class Category(Enum):
     DINING = "Dining & Drinks"
@@ -123,31 +278,59 @@ class Category(Enum):
     TRAVEL = "Travel & Vacation"
 
 
+CATEGORY_BY_VALUE = {c.value: c for c in Category}
+
+
 class IgnoredFrom(Enum):
     BUDGET = "budget"
     EVERYTHING = "everything"
     NOTHING = str()
 
 
+IGNORED_FROM_BY_VALUE = {i.value: i for i in IgnoredFrom}
+
+
+# Templates
+# Every row has a label, one cell per Category and a total, so build the
+# row markup once per cell tag; render_row fills in the escaped cells
+ROW_TEMPLATES = {
+    tag: "<tr>" + f"<{tag}>{{}}</{tag}>" * (len(Category) + 2) + "</tr>"
+    for tag in ("th", "td")
+}
+# The header row only depends on Category, so render it once at import
+TABLE_HEADER = render_table_header()
+
+# Static parts of the summary email; add_body fills in the rest
+EMAIL_TEMPLATE = (
+    "<!DOCTYPE html><html><head><style>"
+    "table {{border-collapse: collapse; width: 100%}} "
+    "th, td {{border: 1px solid black; padding: 8px 12px; text-align: left;}} "
+    "th {{background-color: #f2f2f2;}}"
+    "</style></head><body>"
+    '<table border="1"><thead>{header}</thead><tbody>{rows}</tbody></table>'
+    "{summary}</body></html>"
+)
+
+
+@dataclass(frozen=True, slots=True)
 class Transaction:
-    def __init__(
-        self,
-        transact_date: date,
-        name: str,
-        account_number: int,
-        amount: float,
-        category: Category,
-        ignore: IgnoredFrom,
-    ) -> None:
-        self.date = transact_date
-        self.name = name
-        self.account_number = account_number
-        self.amount = amount
-        self.category = category
-        self.ignore = ignore
+    date: date
+    name: str
+    account_number: int
+    amount_cents: int
+    category: Category
+    ignore: IgnoredFrom
 
 
 class Person:
+    __slots__ = (
+        "name",
+        "email",
+        "account_numbers",
+        "transactions",
+        "_expenses_cents",
+    )
+
     def __init__(
         self,
         name: str,
@@ -157,8 +340,10 @@ class Person:
     ) -> None:
         self.name = name
         self.email = email
-        self.account_numbers = account_numbers
+        self.account_numbers = frozenset(account_numbers)
         self.transactions = transactions
+        # Category totals, with the transaction count they were computed at
+        self._expenses_cents: tuple[int, dict[Category | None, int]] | None = None
 
     def add_transaction(self, transaction: Transaction) -> None:
         self.transactions.append(transaction)
@@ -169,32 +354,62 @@ class Person:
     def get_newest_transaction(self) -> date:
         return max(t.date for t in self.transactions)
 
+    def _get_expenses_cents(self) -> dict[Category | None, int]:
+        # Total every category (and everything, under None) in a single pass,
+        # cached until the transaction list grows (transactions is public, so
+        # appends may bypass add_transaction)
+        count = len(self.transactions)
+        if self._expenses_cents is None or self._expenses_cents[0] != count:
+            totals: dict[Category | None, int] = {c: 0 for c in Category}
+            for t in self.transactions:
+                totals[t.category] += t.amount_cents
+            totals[None] = sum(totals.values())
+            self._expenses_cents = (count, totals)
+        return self._expenses_cents[1]
+
+    def get_expenses_cents(self, category: Category | None = None) -> int:
+        return self._get_expenses_cents()[category]
+
     def get_expenses(self, category: Category | None = None) -> float:
-        if not self.transactions:
-            return 0
-        if not category:
-            return sum(t.amount for t in self.transactions)
-        return sum(t.amount for t in self.transactions if t.category == category)
+        return self.get_expenses_cents(category) / CENTS
+
+    def get_category_expenses(self) -> tuple[dict[Category, float], float]:
+        totals = self._get_expenses_cents()
+        return {c: totals[c] / CENTS for c in Category}, totals[None] / CENTS
 
 
 class Group:
     def __init__(self, members: list[Person]) -> None:
         self.members = members
+        self.members_by_account = {
+            a: p for p in self.members for a in p.account_numbers
+        }
 
     def add_transactions(self, transactions: list[Transaction]) -> None:
         for t in transactions:
-            for p in self.members:
-                if (
-                    t.account_number in p.account_numbers
-                    and t.ignore == IgnoredFrom.NOTHING
-                ):
-                    p.add_transaction(t)
+            p = self.members_by_account.get(t.account_number)
+            if p and t.ignore is IgnoredFrom.NOTHING:
+                p.add_transaction(t)
 
+    # Computed on demand so transactions added straight to a Person count too;
+    # idle members are skipped rather than failing min/max
     def get_oldest_transaction(self) -> date:
-        return min(p.get_oldest_transaction() for p in self.members)
+        oldest = min(
+            (p.get_oldest_transaction() for p in self.members if p.transactions),
+            default=None,
+        )
+        if oldest is None:
+            raise ValueError("Group has no transactions")
+        return oldest
 
     def get_newest_transaction(self) -> date:
-        return max(p.get_newest_transaction() for p in self.members)
+        newest = max(
+            (p.get_newest_transaction() for p in self.members if p.transactions),
+            default=None,
+        )
+        if newest is None:
+            raise ValueError("Group has no transactions")
+        return newest
 
     def get_expenses_difference(
         self, p1: Person, p2: Person, category: Category | None = None
@@ -203,13 +418,15 @@ class Group:
             missing = [p for p in [p1, p2] if p not in self.members]
             if missing:
                 raise ValueError("People args missing from group")
-            return p1.get_expenses(category) - p2.get_expenses(category)
+            return (
+                p1.get_expenses_cents(category) - p2.get_expenses_cents(category)
+            ) / CENTS
         except ValueError as ex:
             logger.error("Invalid input (%s, %s): %s", p1.name, p2.name, ex)
             raise
 
-    def get_expenses(self):
-        return sum(p.get_expenses() for p in self.members)
+    def get_expenses(self) -> float:
+        return sum(p.get_expenses_cents() for p in self.members) / CENTS
 
     def get_debt(self, p1: Person, p2: Person, p1_scale_factor: float = 0.5) -> float:
         try:
@@ -230,72 +447,13 @@ class SummaryEmail:
         self.body = str()
 
     def add_body(self, group: Group) -> None:
-        doc, tag, text = yattag.Doc().tagtext()
-        doc.asis("<!DOCTYPE html>")
-        with tag("html"):
-            # HTML head
-            with tag("head"):
-                doc.asis(
-                    "<style>table {border-collapse: collapse; width: 100%} \
-                    th, td {border: 1px solid black; padding: 8px 12px; text-align: left;} \
-                    th {background-color: #f2f2f2;}</style>"
-                )
-            # HTML body
-            with tag("body"):
-                # Table
-                with tag("table", border="1"):
-                    # Table header
-                    with tag("thead"):
-                        with tag("tr"):
-                            with tag("th"):
-                                text("")
-                            for c in Category:
-                                with tag("th"):
-                                    text(c.value)
-                            with tag("th"):
-                                text("Total")
-                    # Table body
-                    with tag("tbody"):
-                        # Create a row for each person
-                        for p in group.members:
-                            with tag("tr"):
-                                with tag("td"):
-                                    text(p.name)
-                                for c in Category:
-                                    with tag("td"):
-                                        text(to_currency(p.get_expenses(c)))
-                                with tag("td"):
-                                    text(to_currency(p.get_expenses()))
-                        # If there are only two people, create a row for the differences
-                        if len(group.members) == 2:
-                            p1, p2 = group.members
-                            with tag("tr"):
-                                with tag("td"):
-                                    text("Difference")
-                                for c in Category:
-                                    with tag("td"):
-                                        text(
-                                            to_currency(
-                                                group.get_expenses_difference(p1, p2, c)
-                                            )
-                                        )
-                                with tag("td"):
-                                    text(
-                                        to_currency(
-                                            group.get_expenses_difference(p1, p2)
-                                        )
-                                    )
-                # Expenses summary sentence
-                if len(group.members) == 2:
-                    p1, p2 = group.members
-                    k = 0.47  # Just set the scale factor here for now
-                    with tag("p"):
-                        text(
-                            f"Using a scale factor of {k} for {p1.name}, {p1.name} owes {p2.name}: "
-                            f"{to_currency(group.get_debt(p1, p2, k))}"
-                        )
-
-        self.body = doc.getvalue()
+        self.body = EMAIL_TEMPLATE.format_map(
+            {
+                "header": TABLE_HEADER,
+                "rows": render_table_rows(group),
+                "summary": render_summary(group),
+            }
+        )
 
     def add_subject(self, group: Group) -> None:
         min_date = group.get_oldest_transaction()
@@ -303,9 +461,8 @@ class SummaryEmail:
         self.subject = f"Transactions Summary: {min_date.strftime(DISPLAY_DATE)} - {max_date.strftime(DISPLAY_DATE)}"
 
     def send(self) -> None:
-        ses: SESClient = boto3.client("ses", region_name="us-east-1")
         try:
-            ses.send_email(
+            get_ses_client().send_email(
                 Source=self.sender,
                 Destination={"ToAddresses": self.to},
                 Message={
@@ -319,18 +476,13 @@ class SummaryEmail:
 
 
 # Main
-def lambda_handler(event: Any, context: Any) -> None:
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    key = event["Records"][0]["s3"]["object"]["key"]
-
-    # Read data from buckets
-    config = get_config(CONFIG_BUCKET, CONFIG_KEY)
-    validate_config(config)
-    transactions = get_transactions(bucket, key)
-
-    # Construct group and add transactions
+def summarize_file(config: dict, bucket: str, key: str) -> None:
+    # Construct group
     members = get_members(config["People"])
     group = Group(members)
+
+    # Read data from bucket, keeping only rows the group will count
+    transactions = get_transactions(bucket, key, group.members_by_account.keys())
     group.add_transactions(transactions)
 
     # Construct and send email
@@ -338,3 +490,31 @@ def lambda_handler(event: Any, context: Any) -> None:
     email.add_body(group)
     email.add_subject(group)
     email.send()
+
+
+def lambda_handler(event: Any, context: Any) -> None:
+    files = [
+        (r["s3"]["bucket"]["name"], r["s3"]["object"]["key"]) for r in event["Records"]
+    ]
+
+    # Read config from bucket
+    config = get_config(CONFIG_BUCKET, CONFIG_KEY)
+    validate_config(config)
+
+    # Summarize each uploaded file; S3 and SES calls are I/O-bound, so use threads
+    if len(files) == 1:
+        summarize_file(config, *files[0])
+        return
+    # Let every file finish, then fail once for any that didn't, so one bad
+    # file doesn't hide which of the others were already summarized
+    failed = list()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(summarize_file, config, *f) for f in files]
+        for future, (bucket, key) in zip(futures, files):
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error("Error summarizing s3://%s/%s: %s", bucket, key, ex)
+                failed.append(key)
+    if failed:
+        raise RuntimeError(f"Failed to summarize: {', '.join(failed)}")
@@ -3,18 +3,33 @@
 # Author: Rocco Davino
 
 
+import io
+import json
 import unittest
+from datetime import date
+from unittest.mock import patch
 import boto3
+from botocore import exceptions
 from moto import mock_aws
+from typeguard import TypeCheckError
 from main import (
+    get_s3_client,
+    get_ses_client,
     get_config,
     validate_config,
     get_transactions,
+    parse_transactions,
     get_members,
     Group,
     SummaryEmail,
+    Transaction,
     Category,
+    IgnoredFrom,
     to_currency,
+    lambda_handler,
+    CONFIG_BUCKET,
+    CONFIG_KEY,
+    CONFIG_CACHE,
 )
 
 
@@ -24,38 +39,98 @@ CONTENT = "Date,Original Date,Account Type,Account Name,Account Number,Instituti
 # Test get_config output
 CONFIG = '{\n    "People": [\n        {\n            "Name": "George",\n            "Accounts": [\n                1234\n            ],\n            "Email": "boygeorge@gmail.com"\n        },\n        {\n            "Name": "Tootie",\n            "Accounts": [\n                1313\n            ],\n            "Email": "tuttifruity@hotmail.com"\n        }\n    ],\n    "Owner": "bebas@gmail.com"\n}'
 
+# Expected get_transactions output
+TRANSACTIONS = [
+    Transaction(
+        date(2023, 9, 4),
+        "TIKICAT BAR",
+        1234,
+        1266,
+        Category.DINING,
+        IgnoredFrom.NOTHING,
+    ),
+    Transaction(
+        date(2023, 9, 4),
+        "TIKICAT BAR",
+        1234,
+        1266,
+        Category.DINING,
+        IgnoredFrom.BUDGET,
+    ),
+    Transaction(
+        date(2023, 9, 12),
+        "FISH MARKET",
+        2121,
+        4771,
+        Category.GROCERIES,
+        IgnoredFrom.NOTHING,
+    ),
+    Transaction(
+        date(2023, 9, 15),
+        "TIKICAT BAR",
+        1313,
+        1700,
+        Category.DINING,
+        IgnoredFrom.NOTHING,
+    ),
+]
+
+
+# Start moto once for the whole module rather than once per test
+MOCK_AWS = mock_aws()
+
+
+def setUpModule():
+    MOCK_AWS.start()
+
+
+def tearDownModule():
+    MOCK_AWS.stop()
+
 
 class IntegrationTest(unittest.TestCase):
-    def setUp(self):
-        self.bucket = "rmanalyzer-config"
-        self.key = "test.csv"
-        self.content = CONTENT
-        self.config_bucket = "rmanalyzer-config"
-        self.config_key = "config-test.json"
-        self.config = CONFIG
-        self.event = {
+    @classmethod
+    def setUpClass(cls):
+        cls.bucket = "rmanalyzer-config"
+        cls.key = "test.csv"
+        cls.content = CONTENT
+        cls.config_bucket = "rmanalyzer-config"
+        cls.config_key = "config-test.json"
+        cls.config = CONFIG
+        cls.event = {
             "Records": [
                 {
                     "s3": {
-                        "bucket": {"name": self.bucket},
-                        "object": {"key": self.key},
+                        "bucket": {"name": cls.bucket},
+                        "object": {"key": cls.key},
                     }
                 }
             ]
         }
 
-    @mock_aws
-    def test_lambda_handler_body(self):
-        # Mock AWS setup
+        # Mock AWS setup, shared by every test in the class
         s3 = boto3.client("s3")
-        s3.create_bucket(Bucket=self.bucket)
-        s3.put_object(Bucket=self.bucket, Key=self.key, Body=self.content)
-        s3.create_bucket(Bucket=self.config_bucket)
-        s3.put_object(Bucket=self.config_bucket, Key=self.config_key, Body=self.config)
+        s3.create_bucket(Bucket=cls.bucket)
+        s3.put_object(Bucket=cls.bucket, Key=cls.key, Body=cls.content)
+        s3.put_object(Bucket=cls.bucket, Key="a.csv", Body=cls.content)
+        s3.put_object(Bucket=cls.bucket, Key="b.csv", Body=cls.content)
+        s3.put_object(
+            Bucket=cls.bucket, Key="garbage.csv", Body="***THIS IS NOT A SPREADSHEET***"
+        )
+        s3.create_bucket(Bucket=cls.config_bucket)
+        s3.put_object(Bucket=cls.config_bucket, Key=cls.config_key, Body=cls.config)
+        s3.create_bucket(Bucket=CONFIG_BUCKET)
+        s3.put_object(Bucket=CONFIG_BUCKET, Key=CONFIG_KEY, Body=cls.config)
         # Mock the email send; no exception == success
         ses = boto3.client("ses", region_name="us-east-1")
         ses.verify_email_identity(EmailAddress="bebas@gmail.com")
 
+    def setUp(self):
+        CONFIG_CACHE.clear()
+        get_s3_client.cache_clear()
+        get_ses_client.cache_clear()
+
+    def test_lambda_handler_body(self):
         # lambda_handler body
         ###############################
         bucket: str = self.event["Records"][0]["s3"]["bucket"]["name"]
@@ -78,8 +153,10 @@ class IntegrationTest(unittest.TestCase):
         email.send()
         ###############################
 
+        # Check the parsed transactions
+        self.assertEqual(transactions, TRANSACTIONS)
+
         # Check items relevant to the email body
-        self.assertEqual(len(transactions), 4)
         self.assertEqual(len(group.members), 2)
         g = group.members[0]
         t = group.members[1]
@@ -100,6 +177,10 @@ class IntegrationTest(unittest.TestCase):
                 )
         self.assertEqual(to_currency(g.get_expenses()), "12.66")
         self.assertEqual(to_currency(t.get_expenses()), "17.00")
+        expenses, total = t.get_category_expenses()
+        self.assertEqual(to_currency(expenses[Category.DINING]), "17.00")
+        self.assertEqual(to_currency(expenses[Category.GROCERIES]), "0.00")
+        self.assertEqual(to_currency(total), "17.00")
         self.assertEqual(to_currency(group.get_expenses_difference(g, t)), "-4.34")
         self.assertEqual(to_currency(group.get_debt(g, t, 0.47)), "1.28")
         self.assertEqual(email.sender, "bebas@gmail.com")
@@ -110,6 +191,183 @@ class IntegrationTest(unittest.TestCase):
         # Use https://html.onlineviewer.net/
         print(email.body)
 
+    def test_get_transactions_bad_spreadsheet(self):
+        self.assertEqual(get_transactions(self.bucket, "garbage.csv"), [])
+
+    def test_get_transactions_filtered_by_account(self):
+        # Ignored rows and rows on unknown accounts are dropped while parsing
+        transactions = get_transactions(self.bucket, self.key, {1234, 1313})
+        self.assertEqual(transactions, [TRANSACTIONS[0], TRANSACTIONS[3]])
+
+    def test_lambda_handler_multiple_records(self):
+        ses = boto3.client("ses", region_name="us-east-1")
+        sent = ses.get_send_quota()["SentLast24Hours"]
+
+        event = {
+            "Records": [
+                {"s3": {"bucket": {"name": self.bucket}, "object": {"key": k}}}
+                for k in ["a.csv", "b.csv"]
+            ]
+        }
+        lambda_handler(event, None)
+
+        # One summary email per uploaded file, each to both members
+        self.assertEqual(ses.get_send_quota()["SentLast24Hours"], sent + 2 * 2)
+
+    def test_lambda_handler_multiple_records_one_bad(self):
+        ses = boto3.client("ses", region_name="us-east-1")
+        sent = ses.get_send_quota()["SentLast24Hours"]
+
+        event = {
+            "Records": [
+                {"s3": {"bucket": {"name": self.bucket}, "object": {"key": k}}}
+                for k in ["a.csv", "garbage.csv"]
+            ]
+        }
+        with self.assertLogs("main", level="ERROR"):
+            with self.assertRaises(RuntimeError):
+                lambda_handler(event, None)
+
+        # The good file is still summarized before the invocation fails
+        self.assertEqual(ses.get_send_quota()["SentLast24Hours"], sent + 2)
+
+
+class GetConfigTest(unittest.TestCase):
+    # Stub the S3 read; these only exercise get_config's error handling
+    def setUp(self):
+        CONFIG_CACHE.clear()
+
+    def test_get_config_bad_json(self):
+        with (
+            patch("main.get_s3_etag", return_value='"etag"'),
+            patch("main.get_s3_content", return_value=b"Hello, World!"),
+        ):
+            with self.assertRaises(json.JSONDecodeError):
+                get_config("bucket", "key")
+
+    def test_get_config_missing_key(self):
+        error = exceptions.ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        with patch("main.get_s3_etag", side_effect=error):
+            with self.assertRaises(exceptions.ClientError):
+                get_config("bucket", "key")
+
+    def test_get_config_cached_until_changed(self):
+        with (
+            patch("main.get_s3_etag", return_value='"1"'),
+            patch("main.get_s3_content", return_value=CONFIG.encode()) as content,
+        ):
+            first = get_config("bucket", "key")
+            self.assertIs(get_config("bucket", "key"), first)
+            self.assertEqual(content.call_count, 1)
+        with (
+            patch("main.get_s3_etag", return_value='"2"'),
+            patch("main.get_s3_content", return_value=b'{"Owner": "x"}'),
+        ):
+            self.assertEqual(get_config("bucket", "key"), {"Owner": "x"})
+
+
+class ValidateConfigTest(unittest.TestCase):
+    # Pure config checks; build the dicts in memory rather than reading S3
+    def setUp(self):
+        self.config = json.loads(CONFIG)
+
+    def test_validate_config_valid(self):
+        validate_config(self.config)
+
+    def test_validate_config_bad_keys(self):
+        del self.config["People"][0]["Email"]
+        with self.assertRaises(KeyError):
+            validate_config(self.config)
+
+    def test_validate_config_bad_values(self):
+        self.config["People"][1]["Accounts"] = ["1313"]
+        with self.assertRaises(TypeCheckError):
+            validate_config(self.config)
+
+
+class ParseTransactionsTest(unittest.TestCase):
+    def test_parse_transactions_non_finite_amount(self):
+        content = (
+            "Date,Account Number,Name,Amount,Category,Ignored From\n"
+            "2023-01-01,1,x,inf,Groceries,\n"
+            "2023-01-01,1,x,nan,Groceries,\n"
+            "2023-01-01,1,x,1e400,Groceries,\n"
+            "2023-01-02,1,y,12.5,Groceries,\n"
+        )
+        # Bad amounts are logged and skipped rather than failing the file
+        with self.assertLogs("main", level="WARNING"):
+            transactions = list(parse_transactions(io.BytesIO(content.encode())))
+        self.assertEqual([t.amount_cents for t in transactions], [1250])
+
+    def test_parse_transactions_blank_lines(self):
+        content = (
+            "Date,Account Number,Name,Amount,Category,Ignored From\n"
+            "2023-01-01,1,x,1,Groceries,\n"
+            "\n\n\n"
+        )
+        # Blank lines are skipped quietly, as csv.DictReader did
+        with self.assertNoLogs("main", level="WARNING"):
+            transactions = list(parse_transactions(io.BytesIO(content.encode())))
+        self.assertEqual(len(transactions), 1)
+
+    def test_parse_transactions_non_dashed_date(self):
+        content = (
+            "Date,Account Number,Name,Amount,Category,Ignored From\n"
+            "20230101,1,x,1,Groceries,\n"
+            "2023-W01-1,1,x,1,Groceries,\n"
+            "2023-01-02,1,y,1,Groceries,\n"
+        )
+        # Only YYYY-MM-DD dates are accepted, as with the old strptime format
+        with self.assertLogs("main", level="WARNING"):
+            transactions = list(parse_transactions(io.BytesIO(content.encode())))
+        self.assertEqual([t.date for t in transactions], [date(2023, 1, 2)])
+
+    def test_parse_transactions_unknown_ignored_from(self):
+        content = (
+            "Date,Account Number,Name,Amount,Category,Ignored From\n"
+            "2023-01-01,1,x,1,Groceries,weird\n"
+            "2023-01-01,1,x,1,Groceries,budget\n"
+        )
+        # Unknown values are still logged as invalid, even when filtering
+        with self.assertLogs("main", level="WARNING") as logs:
+            transactions = list(parse_transactions(io.BytesIO(content.encode()), {1}))
+        self.assertEqual(transactions, [])
+        self.assertEqual(len(logs.records), 1)
+
+
+class PersonTest(unittest.TestCase):
+    def setUp(self):
+        self.person = get_members(json.loads(CONFIG)["People"])[1]
+
+    def test_expenses_updated_by_add_transaction(self):
+        self.assertEqual(self.person.get_expenses(), 0.0)
+        self.person.add_transaction(TRANSACTIONS[-1])
+        self.assertEqual(self.person.get_expenses(), 17.0)
+
+    def test_expenses_updated_by_direct_append(self):
+        self.assertEqual(self.person.get_expenses(), 0.0)
+        self.person.transactions.append(TRANSACTIONS[-1])
+        self.assertEqual(self.person.get_expenses(), 17.0)
+
+
+class GroupTest(unittest.TestCase):
+    def test_date_range_with_idle_member(self):
+        group = Group(get_members(json.loads(CONFIG)["People"]))
+        # Only Tootie (account 1313) has a transaction
+        group.add_transactions(TRANSACTIONS[-1:])
+        self.assertEqual(group.get_oldest_transaction(), date(2023, 9, 15))
+        self.assertEqual(group.get_newest_transaction(), date(2023, 9, 15))
+
+    def test_date_range_with_direct_add(self):
+        group = Group(get_members(json.loads(CONFIG)["People"]))
+        group.add_transactions(TRANSACTIONS[-1:])
+        # Transactions added straight to a member still widen the range
+        group.members[0].add_transaction(TRANSACTIONS[0])
+        self.assertEqual(group.get_oldest_transaction(), date(2023, 9, 4))
+        self.assertEqual(group.get_newest_transaction(), date(2023, 9, 15))
+
 
 def main():
     unittest.main()